@@ -16,18 +16,28 @@ Features:
 
 import asyncio
 import websockets
-import json
+import orjson
 import logging
 import signal
 import http
 import sqlite3
+import aiosqlite
 import unicodedata
 import re
 import os
+import time
 import urllib.parse
 from datetime import datetime, timezone, timedelta
-from collections import defaultdict
+from collections import defaultdict, deque
 from pathlib import Path
+from aiosqlitepool import SQLiteConnectionPool
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import OP_BINARY, OP_TEXT
+
+try:
+    import uvloop
+except ImportError:  # e.g. Windows dev machines; fall back to the stock loop
+    uvloop = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -38,8 +48,29 @@ logger = logging.getLogger("MultiAgentRelay")
 # Store connected clients
 clients = {}
 
-# Message queue for offline/disconnected agents
-message_queue = defaultdict(list)
+# Immutable (client_id, websocket) snapshot of `clients` for broadcast iteration;
+# rebuilt only on join/leave via _rebuild_view()
+clients_view = ()
+
+# Broadcast fan-out is split across FANOUT_SHARDS worker tasks, each owning the
+# clients whose id hashes to it: per-recipient order is kept, a slow shard does
+# not hold up the others, and the sender's receive loop never waits on fan-out
+FANOUT_SHARDS = 4
+fanout_queues = [asyncio.Queue() for _ in range(FANOUT_SHARDS)]
+client_shards = ((),) * FANOUT_SHARDS
+
+# Message queue for offline/disconnected agents: (coalesce_key, encoded payload)
+# entries, capped per agent so a busy room cannot grow it without bound
+QUEUE_MAX_PER_AGENT = 1000
+message_queue = defaultdict(lambda: deque(maxlen=QUEUE_MAX_PER_AGENT))
+
+# Number of queued entries dropped (oldest first) per agent since its last replay
+queue_dropped = defaultdict(int)
+
+# Transport write-buffer watermarks: above the high mark a peer counts as slow and
+# broadcasts are queued for it instead of awaited
+SLOW_CLIENT_HIGH_WATER = 512 * 1024
+SLOW_CLIENT_LOW_WATER = 16 * 1024
 
 # Rooms known to the relay (in-memory, source of truth)
 rooms = {"general"}
@@ -71,6 +102,44 @@ AGENT_SANDBOXES = {
 # Max history messages returned per room on connect
 HISTORY_CAP_PER_ROOM = 200
 
+# orjson encodes straight to UTF-8 bytes (used as-is for HTTP bodies);
+# websocket frames are decoded so clients keep receiving text frames.
+def dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+
+loads = orjson.loads
+
+# Pre-encoded frames for the highest-frequency control messages; only the
+# variable fields are filled in (JSON-encoded via dumps, timestamps are JSON-safe)
+SERVER_CAPABILITIES = {
+    "relay": True,
+    "persistence": True,
+    "history": True,
+    "message_queue": True,
+    "rooms": True
+}
+WELCOME_TEMPLATE = ('{"protocol_version":"0.3","message_type":"WELCOME","session_id":%s,'
+                    '"server_capabilities":' + dumps(SERVER_CAPABILITIES) + ','
+                    '"heartbeat_interval":30,"connected_agents":%s}')
+ACK_TEMPLATE = '{"protocol_version":"0.3","message_type":"ACK","message_id":%s,"timestamp":"%s"}'
+PONG_TEMPLATE = '{"protocol_version":"0.3","message_type":"PONG","timestamp":"%s"}'
+
+# Last rendered timestamp, reused by every frame built within the same millisecond
+_ts_cache_ms = 0
+_ts_cache_iso = ""
+
+
+def utc_timestamp() -> str:
+    """Current UTC time as ISO-8601 with a 'Z' suffix, rebuilt at most once per ms."""
+    global _ts_cache_ms, _ts_cache_iso
+    now_ms = time.time_ns() // 1_000_000
+    if now_ms != _ts_cache_ms:
+        _ts_cache_ms = now_ms
+        _ts_cache_iso = datetime.fromtimestamp(now_ms / 1000, timezone.utc).isoformat(
+            timespec="milliseconds").replace("+00:00", "Z")
+    return _ts_cache_iso
+
 
 def normalize_room(name: str) -> str:
     """Normalize room names: remove accents, lowercase, unify separators."""
@@ -88,11 +157,84 @@ def normalize_room(name: str) -> str:
 # Database setup
 DB_PATH = "/data/relay_server.db"
 
+# Long-lived aiosqlite connections (created in init_database).
+# WAL allows one writer alongside many readers, so writes get a dedicated
+# single-connection pool and reads share a larger one.
+DB_READER_POOL_SIZE = 10
+db_writer_pool = None
+db_reader_pool = None
+
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA journal_size_limit=67108864",
+    "PRAGMA wal_autocheckpoint=1000",
+)
+
+# Per-connection sqlite3 statement cache size; every query below is a fixed
+# string so repeated calls reuse the already-prepared statement
+DB_CACHED_STATEMENTS = 256
+
+# Message rows waiting for message_writer(); readers join() it first so they see
+# everything already ACKed
+MESSAGE_WRITE_BATCH = 500
+pending_writes = asyncio.Queue()
+
+# A re-sent message_id keeps the first stored copy (retries are idempotent, and
+# DO NOTHING avoids REPLACE's delete + re-insert of the row and its index entries).
+# Only the message_id conflict is skipped; NOT NULL violations still fail the insert
+SQL_INSERT_MESSAGE = '''INSERT INTO messages
+    (message_id, sender, content, timestamp, message_type, room, display_name)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(message_id) DO NOTHING'''
+
+SQL_HISTORY_SINCE = '''SELECT message_id, sender, content, timestamp, message_type, room, display_name
+    FROM messages
+    WHERE timestamp > ?
+    ORDER BY timestamp ASC'''
+
+SQL_HISTORY_SINCE_ROOM = '''SELECT message_id, sender, content, timestamp, message_type, room, display_name
+    FROM messages
+    WHERE timestamp > ? AND room = ?
+    ORDER BY timestamp ASC'''
+
+SQL_HISTORY_LATEST_ROOM = '''SELECT message_id, sender, content, timestamp, message_type, room, display_name
+    FROM messages WHERE room = ?
+    ORDER BY timestamp DESC LIMIT ?'''
+
+SQL_DISTINCT_ROOMS = "SELECT DISTINCT room FROM messages WHERE room IS NOT NULL"
+
+SQL_DELETE_ROOM = "DELETE FROM messages WHERE room = ?"
+
+# Window of the most recently stored rows (SQL_INSERT_MESSAGE column order), kept by
+# message_writer so since_timestamp history can skip SQLite. Every stored message
+# with a timestamp above recent_floor is in the window; None until init_database.
+RECENT_MESSAGES_MAX = 500
+recent_messages = deque()
+recent_message_ids = set()
+recent_floor = None
+
+
+async def _connect_db():
+    """Connection factory for the pools: open and apply tuned PRAGMAs."""
+    conn = await aiosqlite.connect(DB_PATH, cached_statements=DB_CACHED_STATEMENTS)
+    for pragma in DB_PRAGMAS:
+        async with conn.execute(pragma):
+            pass
+    return conn
+
 
 def init_database():
-    """Initialize SQLite database"""
+    """Initialize SQLite database and the connection pools"""
+    global db_writer_pool, db_reader_pool, recent_floor
     Path("/data").mkdir(exist_ok=True)
     conn = sqlite3.connect(DB_PATH)
+    # WAL is persistent in the file; set it here so the startup sync reads already use it
+    conn.execute("PRAGMA journal_mode=WAL")
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS messages
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -119,9 +261,18 @@ def init_database():
                  (agent_id TEXT PRIMARY KEY,
                   last_seen TEXT NOT NULL,
                   status TEXT DEFAULT 'online')''')
+    # History queries filter/sort by timestamp, optionally within one room
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_ts ON messages(room, timestamp)")
+    c.execute("ANALYZE")
     conn.commit()
+    # Messages stored before startup are only in SQLite
+    c.execute("SELECT MAX(timestamp) FROM messages")
+    recent_floor = c.fetchone()[0] or ""
     conn.close()
-    logger.info("✅ Database initialized")
+    db_writer_pool = SQLiteConnectionPool(_connect_db, pool_size=1)
+    db_reader_pool = SQLiteConnectionPool(_connect_db, pool_size=DB_READER_POOL_SIZE)
+    logger.info(f"✅ Database initialized (WAL, 1 writer + {DB_READER_POOL_SIZE} readers)")
 
     # Rebuild in-memory rooms set from DB
     _load_rooms_from_db()
@@ -133,7 +284,7 @@ def _load_rooms_from_db():
     try:
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
-        c.execute("SELECT DISTINCT room FROM messages WHERE room IS NOT NULL")
+        c.execute(SQL_DISTINCT_ROOMS)
         db_rooms = {row[0] for row in c.fetchall() if row[0]}
         conn.close()
         rooms = db_rooms | {"general"}
@@ -143,21 +294,88 @@ def _load_rooms_from_db():
 
 
 def store_message(message_id, sender, content, timestamp, message_type='MESSAGE', room='general', display_name=None):
-    """Store message in database"""
+    """Queue a message row for the background writer"""
+    if isinstance(timestamp, (int, float)):
+        # The TEXT column stores numbers as text anyway; converting here keeps the
+        # recent window's copy identical to the row SQLite returns
+        timestamp = str(timestamp)
+    pending_writes.put_nowait(
+        (message_id, sender, content, timestamp, message_type, room or 'general', display_name))
+
+
+def _remember_messages(rows, all_inserted):
+    """Add freshly stored rows to the recent window, evicting the oldest."""
+    global recent_floor
+    if not all_inserted:
+        # Some rows were duplicates we can't single out; leave their range to SQLite
+        recent_floor = max(recent_floor, *(row[3] for row in rows))
+        return
+    for row in rows:
+        if row[0] in recent_message_ids:
+            continue
+        recent_messages.append(row)
+        recent_message_ids.add(row[0])
+    while len(recent_messages) > RECENT_MESSAGES_MAX:
+        evicted = recent_messages.popleft()
+        recent_message_ids.discard(evicted[0])
+        recent_floor = max(recent_floor, evicted[3])
+
+
+def _forget_rooms(room_names):
+    """Drop deleted rooms from the recent window."""
+    global recent_messages
+    dropped = set(room_names)
+    recent_messages = deque(row for row in recent_messages if row[5] not in dropped)
+    recent_message_ids.clear()
+    recent_message_ids.update(row[0] for row in recent_messages)
+
+
+async def _write_message_batch(rows):
+    """Insert rows in a single transaction; retry one by one if the batch fails."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''INSERT OR REPLACE INTO messages 
-                    (message_id, sender, content, timestamp, message_type, room, display_name)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                 (message_id, sender, content, timestamp, message_type, room or 'general', display_name))
-        conn.commit()
-        conn.close()
+        async with db_writer_pool.connection() as conn:
+            changes_before = conn.total_changes
+            async with conn.executemany(SQL_INSERT_MESSAGE, rows):
+                pass
+            await conn.commit()
+            all_inserted = conn.total_changes - changes_before == len(rows)
+        _remember_messages(rows, all_inserted)
     except Exception as e:
-        logger.error(f"Failed to store message: {e}")
+        if len(rows) == 1:
+            logger.error(f"Failed to store message: {e}")
+            return
+        # A single bad row (e.g. missing timestamp) must not drop the rest of the batch
+        for row in rows:
+            await _write_message_batch([row])
+
+
+async def message_writer():
+    """Drain pending_writes, committing up to MESSAGE_WRITE_BATCH rows per transaction."""
+    while True:
+        batch = [await pending_writes.get()]
+        while len(batch) < MESSAGE_WRITE_BATCH and not pending_writes.empty():
+            batch.append(pending_writes.get_nowait())
+        try:
+            await _write_message_batch(batch)
+        finally:
+            for _ in batch:
+                pending_writes.task_done()
+
+
+def _row_to_message(row):
+    """Convert a messages row (history SELECT column order) to a history dict."""
+    return {
+        "message_id": row[0],
+        "sender": row[1],
+        "display_name": row[6] or row[1],
+        "content": row[2],
+        "timestamp": row[3],
+        "message_type": row[4],
+        "room": row[5] or 'general'
+    }
 
 
-def get_message_history(since_timestamp=None, room=None, limit=None):
+async def get_message_history(since_timestamp=None, room=None, limit=None):
     """Retrieve message history.
     
     Args:
@@ -167,124 +385,80 @@ def get_message_history(since_timestamp=None, room=None, limit=None):
     """
     cap = limit if (limit and isinstance(limit, int) and 1 <= limit <= HISTORY_CAP_PER_ROOM) else HISTORY_CAP_PER_ROOM
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
-        if since_timestamp:
+        await pending_writes.join()
+        if since_timestamp and isinstance(since_timestamp, str) and recent_floor is not None and since_timestamp >= recent_floor:
+            # Everything newer than since_timestamp is in the recent window
+            room_norm = normalize_room(room) if room else None
+            rows = [row for row in recent_messages
+                    if row[3] > since_timestamp and (room_norm is None or row[5] == room_norm)]
+            rows.sort(key=lambda row: row[3])
+            return [_row_to_message(row) for row in rows]
+        async with db_reader_pool.connection() as conn:
+            if since_timestamp:
+                if room:
+                    room_norm = normalize_room(room)
+                    rows = await conn.execute_fetchall(SQL_HISTORY_SINCE_ROOM, (since_timestamp, room_norm))
+                else:
+                    rows = await conn.execute_fetchall(SQL_HISTORY_SINCE, (since_timestamp,))
+                return [_row_to_message(row) for row in rows]
+
+            # No since_timestamp — return last N messages per room
             if room:
+                # Single room request (fast path for dashboard)
                 room_norm = normalize_room(room)
-                c.execute('''SELECT message_id, sender, content, timestamp, message_type, room, display_name
-                            FROM messages 
-                            WHERE timestamp > ? AND room = ?
-                            ORDER BY timestamp ASC''', (since_timestamp, room_norm))
+                rows = await conn.execute_fetchall(SQL_HISTORY_LATEST_ROOM, (room_norm, cap))
+                return [_row_to_message(row) for row in reversed(rows)]
             else:
-                c.execute('''SELECT message_id, sender, content, timestamp, message_type, room, display_name
-                            FROM messages 
-                            WHERE timestamp > ? 
-                            ORDER BY timestamp ASC''', (since_timestamp,))
-            messages = []
-            for row in c.fetchall():
-                messages.append({
-                    "message_id": row[0],
-                    "sender": row[1],
-                    "display_name": row[6] or row[1],
-                    "content": row[2],
-                    "timestamp": row[3],
-                    "message_type": row[4],
-                    "room": row[5] or 'general'
-                })
-            conn.close()
-            return messages
-
-        # No since_timestamp — return last N messages per room
-        if room:
-            # Single room request (fast path for dashboard)
-            room_norm = normalize_room(room)
-            c.execute('''SELECT message_id, sender, content, timestamp, message_type, room, display_name
-                        FROM messages WHERE room = ?
-                        ORDER BY timestamp DESC LIMIT ?''',
-                     (room_norm, cap))
-            rows = c.fetchall()
-            conn.close()
-            messages = []
-            for row in reversed(rows):
-                messages.append({
-                    "message_id": row[0],
-                    "sender": row[1],
-                    "display_name": row[6] or row[1],
-                    "content": row[2],
-                    "timestamp": row[3],
-                    "message_type": row[4],
-                    "room": row[5] or 'general'
-                })
-            return messages
-        else:
-            # All rooms — return last cap messages per room
-            c.execute('''SELECT DISTINCT room FROM messages WHERE room IS NOT NULL''')
-            all_rooms = [row[0] for row in c.fetchall()]
-            messages = []
-            for r in all_rooms:
-                c.execute('''SELECT message_id, sender, content, timestamp, message_type, room, display_name
-                            FROM messages WHERE room = ?
-                            ORDER BY timestamp DESC LIMIT ?''',
-                         (r, cap))
-                rows = c.fetchall()
-                for row in reversed(rows):
-                    messages.append({
-                        "message_id": row[0],
-                        "sender": row[1],
-                        "display_name": row[6] or row[1],
-                        "content": row[2],
-                        "timestamp": row[3],
-                        "message_type": row[4],
-                        "room": row[5] or 'general'
-                    })
-            conn.close()
-            # Sort all messages by timestamp
-            messages.sort(key=lambda m: m["timestamp"])
-            return messages
+                # All rooms — return last cap messages per room
+                all_rooms = [row[0] for row in await conn.execute_fetchall(SQL_DISTINCT_ROOMS)]
+                messages = []
+                for r in all_rooms:
+                    rows = await conn.execute_fetchall(SQL_HISTORY_LATEST_ROOM, (r, cap))
+                    messages.extend(_row_to_message(row) for row in reversed(rows))
+                # Sort all messages by timestamp
+                messages.sort(key=lambda m: m["timestamp"])
+                return messages
     except Exception as e:
         logger.error(f"Failed to retrieve history: {e}")
         return []
 
 
-def get_room_stats():
+async def get_room_stats():
     """Return stats for all rooms: message count and last activity."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''SELECT room, COUNT(*) as msg_count, MAX(timestamp) as last_msg
-                    FROM messages
-                    WHERE room IS NOT NULL
-                    GROUP BY room
-                    ORDER BY last_msg DESC''')
+        await pending_writes.join()
+        async with db_reader_pool.connection() as conn:
+            rows = await conn.execute_fetchall('''SELECT room, COUNT(*) as msg_count, MAX(timestamp) as last_msg
+                        FROM messages
+                        WHERE room IS NOT NULL
+                        GROUP BY room
+                        ORDER BY last_msg DESC''')
         stats = []
-        for row in c.fetchall():
+        for row in rows:
             stats.append({
                 "room": row[0],
                 "message_count": row[1],
                 "last_message": row[2]
             })
-        conn.close()
         return stats
     except Exception as e:
         logger.error(f"Failed to get room stats: {e}")
         return []
 
 
-def delete_rooms(room_names: list):
+async def delete_rooms(room_names: list):
     """Delete messages from specified rooms and remove from in-memory set."""
     global rooms
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        deleted_total = 0
-        for room in room_names:
-            c.execute("DELETE FROM messages WHERE room = ?", (room,))
-            deleted_total += c.rowcount
-            rooms.discard(room)
-        conn.commit()
-        conn.close()
+        await pending_writes.join()
+        async with db_writer_pool.connection() as conn:
+            deleted_total = 0
+            for room in room_names:
+                async with conn.execute(SQL_DELETE_ROOM, (room,)) as cursor:
+                    deleted_total += cursor.rowcount
+                rooms.discard(room)
+            await conn.commit()
+        _forget_rooms(room_names)
         logger.info(f"🗑️  Deleted {deleted_total} messages from {len(room_names)} rooms")
         return deleted_total
     except Exception as e:
@@ -292,20 +466,19 @@ def delete_rooms(room_names: list):
         return 0
 
 
-def purge_inactive_rooms(inactive_hours: int = 24):
+async def purge_inactive_rooms(inactive_hours: int = 24):
     """Delete all rooms with no activity in the last N hours, except 'general' and 'sync'."""
     cutoff = (datetime.now(timezone.utc) - timedelta(hours=inactive_hours)).isoformat()
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''SELECT room FROM messages
-                    WHERE room NOT IN ('general', 'sync')
-                    GROUP BY room
-                    HAVING MAX(timestamp) < ?''', (cutoff,))
-        inactive = [row[0] for row in c.fetchall()]
-        conn.close()
+        await pending_writes.join()
+        async with db_reader_pool.connection() as conn:
+            rows = await conn.execute_fetchall('''SELECT room FROM messages
+                        WHERE room NOT IN ('general', 'sync')
+                        GROUP BY room
+                        HAVING MAX(timestamp) < ?''', (cutoff,))
+        inactive = [row[0] for row in rows]
         if inactive:
-            deleted = delete_rooms(inactive)
+            deleted = await delete_rooms(inactive)
             logger.info(f"🧹 Purged {len(inactive)} inactive rooms ({deleted} messages deleted)")
         return inactive
     except Exception as e:
@@ -341,7 +514,7 @@ except Exception as e:
 '''],
             capture_output=True, text=True, timeout=15
         )
-        return json.loads(result.stdout.strip() or '[]')
+        return loads(result.stdout.strip() or '[]')
     except Exception as e:
         logger.error(f"workspace files error: {e}")
         return []
@@ -447,7 +620,7 @@ except Exception as e:
         )
         raw = result.stdout.strip()
         if raw:
-            data = json.loads(raw)
+            data = loads(raw)
             # Ensure required fields exist
             if 'mode' not in data:
                 data['mode'] = 'idle'
@@ -460,7 +633,7 @@ except Exception as e:
         return {"mode": "idle", "step_log": [], "agent_id": agent_id, "display_name": display_name, "error": str(e)}
 
 
-def health_check(path, request_headers):
+async def health_check(path, request_headers):
     """HTTP endpoints: health check + admin room management + workspace"""
     if path == "/healthz":
         return http.HTTPStatus.OK, {"Content-Type": "text/plain"}, b"OK\n"
@@ -470,8 +643,8 @@ def health_check(path, request_headers):
         auth = request_headers.get("X-Admin-Secret", "")
         if auth != ADMIN_SECRET:
             return http.HTTPStatus.UNAUTHORIZED, {}, b"Unauthorized\n"
-        stats = get_room_stats()
-        body = json.dumps({"rooms": stats, "total": len(stats)}).encode()
+        stats = await get_room_stats()
+        body = orjson.dumps({"rooms": stats, "total": len(stats)})
         return http.HTTPStatus.OK, {"Content-Type": "application/json"}, body
 
     # Admin: purge inactive rooms (GET with ?hours=N&secret=KEY)
@@ -492,12 +665,12 @@ def health_check(path, request_headers):
                 hours = int(path.split("hours=")[1].split("&")[0])
             except Exception:
                 pass
-        purged = purge_inactive_rooms(hours)
-        body = json.dumps({
+        purged = await purge_inactive_rooms(hours)
+        body = orjson.dumps({
             "purged_rooms": purged,
             "count": len(purged),
             "inactive_threshold_hours": hours
-        }).encode()
+        })
         logger.info(f"🧹 Admin purge: removed {len(purged)} rooms (inactive > {hours}h)")
         return http.HTTPStatus.OK, {"Content-Type": "application/json"}, body
 
@@ -511,7 +684,7 @@ def health_check(path, request_headers):
                 "display_name": info['display_name'],
                 "sandbox_id": info['sandbox_id']
             })
-        body = json.dumps({"agents": agents_info}).encode()
+        body = orjson.dumps({"agents": agents_info})
         return http.HTTPStatus.OK, cors, body
 
     # Workspace: list files for an agent
@@ -523,15 +696,15 @@ def health_check(path, request_headers):
         params = urllib.parse.parse_qs(parts[1]) if len(parts) > 1 else {}
         directory = params.get('dir', ['/tmp/manus_assets'])[0]
         if agent_id not in AGENT_SANDBOXES:
-            return http.HTTPStatus.NOT_FOUND, cors, json.dumps({"error": f"Unknown agent: {agent_id}"}).encode()
+            return http.HTTPStatus.NOT_FOUND, cors, orjson.dumps({"error": f"Unknown agent: {agent_id}"})
         sandbox_id = AGENT_SANDBOXES[agent_id]['sandbox_id']
-        files = get_workspace_files(sandbox_id, directory)
-        body = json.dumps({
+        files = await asyncio.to_thread(get_workspace_files, sandbox_id, directory)
+        body = orjson.dumps({
             "agent_id": agent_id,
             "display_name": AGENT_SANDBOXES[agent_id]['display_name'],
             "directory": directory,
             "files": files
-        }).encode()
+        })
         return http.HTTPStatus.OK, cors, body
 
     # Workspace: read a specific file
@@ -543,16 +716,16 @@ def health_check(path, request_headers):
         params = urllib.parse.parse_qs(parts[1]) if len(parts) > 1 else {}
         file_path = params.get('path', [''])[0]
         if agent_id not in AGENT_SANDBOXES:
-            return http.HTTPStatus.NOT_FOUND, cors, json.dumps({"error": f"Unknown agent: {agent_id}"}).encode()
+            return http.HTTPStatus.NOT_FOUND, cors, orjson.dumps({"error": f"Unknown agent: {agent_id}"})
         if not file_path:
-            return http.HTTPStatus.BAD_REQUEST, cors, json.dumps({"error": "Missing path parameter"}).encode()
+            return http.HTTPStatus.BAD_REQUEST, cors, orjson.dumps({"error": "Missing path parameter"})
         sandbox_id = AGENT_SANDBOXES[agent_id]['sandbox_id']
-        content = get_workspace_file_content(sandbox_id, file_path)
-        body = json.dumps({
+        content = await asyncio.to_thread(get_workspace_file_content, sandbox_id, file_path)
+        body = orjson.dumps({
             "agent_id": agent_id,
             "path": file_path,
             "content": content
-        }).encode()
+        })
         return http.HTTPStatus.OK, cors, body
 
     # Workspace: get terminal output (last N lines of agent log)
@@ -564,15 +737,15 @@ def health_check(path, request_headers):
         params = urllib.parse.parse_qs(parts[1]) if len(parts) > 1 else {}
         lines = int(params.get('lines', ['50'])[0])
         if agent_id not in AGENT_SANDBOXES:
-            return http.HTTPStatus.NOT_FOUND, cors, json.dumps({"error": f"Unknown agent: {agent_id}"}).encode()
+            return http.HTTPStatus.NOT_FOUND, cors, orjson.dumps({"error": f"Unknown agent: {agent_id}"})
         sandbox_id = AGENT_SANDBOXES[agent_id]['sandbox_id']
-        terminal_output = get_workspace_terminal(sandbox_id, agent_id, lines)
-        body = json.dumps({
+        terminal_output = await asyncio.to_thread(get_workspace_terminal, sandbox_id, agent_id, lines)
+        body = orjson.dumps({
             "agent_id": agent_id,
             "display_name": AGENT_SANDBOXES[agent_id]['display_name'],
             "lines": lines,
             "output": terminal_output
-        }).encode()
+        })
         return http.HTTPStatus.OK, cors, body
 
     # Workspace: screenshot of agent sandbox
@@ -581,14 +754,14 @@ def health_check(path, request_headers):
         cors = {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"}
         agent_id = path.replace("/workspace/", "").replace("/screenshot", "").strip("/").split("?")[0]
         if agent_id not in AGENT_SANDBOXES:
-            return http.HTTPStatus.NOT_FOUND, cors, json.dumps({"error": f"Unknown agent: {agent_id}"}).encode()
+            return http.HTTPStatus.NOT_FOUND, cors, orjson.dumps({"error": f"Unknown agent: {agent_id}"})
         sandbox_id = AGENT_SANDBOXES[agent_id]['sandbox_id']
-        result = get_workspace_screenshot(sandbox_id)
-        body = json.dumps({
+        result = await asyncio.to_thread(get_workspace_screenshot, sandbox_id)
+        body = orjson.dumps({
             "agent_id": agent_id,
             "display_name": AGENT_SANDBOXES[agent_id]['display_name'],
             **result
-        }).encode()
+        })
         return http.HTTPStatus.OK, cors, body
     # Workspace: get agent activity state (mode, step_log, current_url, etc.)
     # GET /workspace/{agent_id}/activity
@@ -596,12 +769,12 @@ def health_check(path, request_headers):
         cors = {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"}
         agent_id = path.replace("/workspace/", "").replace("/activity", "").strip("/").split("?")[0]
         if agent_id not in AGENT_SANDBOXES:
-            return http.HTTPStatus.NOT_FOUND, cors, json.dumps({"error": f"Unknown agent: {agent_id}"}).encode()
+            return http.HTTPStatus.NOT_FOUND, cors, orjson.dumps({"error": f"Unknown agent: {agent_id}"})
         sandbox_id = AGENT_SANDBOXES[agent_id]['sandbox_id']
         display_name = AGENT_SANDBOXES[agent_id]['display_name']
         # Try to read /tmp/agent_activity.json from the sandbox
-        activity_data = get_workspace_activity(sandbox_id, agent_id, display_name)
-        body = json.dumps(activity_data).encode()
+        activity_data = await asyncio.to_thread(get_workspace_activity, sandbox_id, agent_id, display_name)
+        body = orjson.dumps(activity_data)
         return http.HTTPStatus.OK, cors, body
     # Workspace: register/update sandbox ID for an agent
     # GET /workspace/register?agent_id=manus_agent_042&sandbox_id=abc123&secret=KEY
@@ -611,18 +784,47 @@ def health_check(path, request_headers):
         params = urllib.parse.parse_qs(parts[1]) if len(parts) > 1 else {}
         secret = params.get('secret', [''])[0]
         if secret != ADMIN_SECRET:
-            return http.HTTPStatus.UNAUTHORIZED, cors, json.dumps({"error": "Unauthorized"}).encode()
+            return http.HTTPStatus.UNAUTHORIZED, cors, orjson.dumps({"error": "Unauthorized"})
         agent_id = params.get('agent_id', [''])[0]
         sandbox_id = params.get('sandbox_id', [''])[0]
         display_name = params.get('display_name', [agent_id])[0]
         if not agent_id or not sandbox_id:
-            return http.HTTPStatus.BAD_REQUEST, cors, json.dumps({"error": "Missing agent_id or sandbox_id"}).encode()
+            return http.HTTPStatus.BAD_REQUEST, cors, orjson.dumps({"error": "Missing agent_id or sandbox_id"})
         AGENT_SANDBOXES[agent_id] = {'sandbox_id': sandbox_id, 'display_name': display_name}
         logger.info(f"📦 Workspace registered: {agent_id} -> {sandbox_id}")
-        body = json.dumps({"ok": True, "agent_id": agent_id, "sandbox_id": sandbox_id}).encode()
+        body = orjson.dumps({"ok": True, "agent_id": agent_id, "sandbox_id": sandbox_id})
         return http.HTTPStatus.OK, cors, body
 
 
+# Messages smaller than this go out uncompressed: deflating ~100-byte ACK/PONG
+# frames costs more CPU than the bytes it saves
+COMPRESSION_MIN_SIZE = 1024
+
+
+class SelectivePerMessageDeflate(PerMessageDeflate):
+    """permessage-deflate that leaves small single-frame messages uncompressed."""
+
+    def encode(self, frame):
+        # RSV1 is per message, so skipping one leaves the shared compressor untouched
+        if frame.fin and frame.opcode in (OP_TEXT, OP_BINARY) and len(frame.data) < COMPRESSION_MIN_SIZE:
+            return frame
+        return super().encode(frame)
+
+
+class SelectiveDeflateFactory(ServerPerMessageDeflateFactory):
+    """Negotiates permessage-deflate as usual but hands out SelectivePerMessageDeflate."""
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, ext = super().process_request_params(params, accepted_extensions)
+        return response_params, SelectivePerMessageDeflate(
+            ext.remote_no_context_takeover,
+            ext.local_no_context_takeover,
+            ext.remote_max_window_bits,
+            ext.local_max_window_bits,
+            ext.compress_settings,
+        )
+
+
 async def send_error(websocket, error_code, error_message, recoverable=True):
     error = {
         "protocol_version": "0.3",
@@ -630,46 +832,127 @@ async def send_error(websocket, error_code, error_message, recoverable=True):
         "error_code": error_code,
         "error_message": error_message,
         "recoverable": recoverable,
-        "timestamp": datetime.utcnow().isoformat() + "Z"
+        "timestamp": utc_timestamp()
     }
     try:
-        await websocket.send(json.dumps(error))
+        await websocket.send(dumps(error))
     except Exception:
         pass
 
 
-async def broadcast_message(message, sender_id):
+def enqueue_message(client_id, payload, key=None):
+    """Queue an encoded payload for a peer; entries sharing a key keep only the latest."""
+    dq = message_queue[client_id]
+    if key is not None:
+        for entry in dq:
+            if entry[0] == key:
+                dq.remove(entry)
+                break
+    if len(dq) == dq.maxlen:
+        queue_dropped[client_id] += 1
+    dq.append((key, payload))
+
+
+def _rebuild_view():
+    global clients_view, client_shards
+    clients_view = tuple((client_id, info["websocket"]) for client_id, info in clients.items())
+    shards = [[] for _ in range(FANOUT_SHARDS)]
+    for client_id, ws in clients_view:
+        shards[hash(client_id) % FANOUT_SHARDS].append((client_id, ws))
+    client_shards = tuple(tuple(shard) for shard in shards)
+
+
+def is_slow(websocket):
+    """True when the peer is not draining its socket fast enough."""
+    return websocket.transport.get_write_buffer_size() > SLOW_CLIENT_HIGH_WATER
+
+
+async def deliver(client_id, websocket, payload):
+    """Send a payload, replaying anything queued while the peer was slow first."""
+    if client_id in message_queue and message_queue[client_id]:
+        await send_queued_messages(websocket, client_id)
+    await websocket.send(payload)
+
+
+def broadcast_message(message, sender_id):
+    """Encode once and hand the payload to every fan-out shard."""
+    payload = dumps(message)
+    # Only the latest presence event per agent matters to a peer that missed them
+    key = None
+    if message.get("message_type") in ("AGENT_JOINED", "AGENT_LEFT"):
+        key = ("presence", message.get("sender"))
+    for queue in fanout_queues:
+        queue.put_nowait((payload, key, sender_id))
+
+
+async def _fanout(shard_clients, payload, key, sender_id):
+    targets = []
+    for client_id, ws in shard_clients:
+        if client_id == sender_id:
+            continue
+        if is_slow(ws):
+            enqueue_message(client_id, payload, key)
+            logger.warning(f"🐢 {client_id} is slow, queued message")
+            continue
+        targets.append((client_id, ws))
+    results = await asyncio.gather(
+        *(deliver(client_id, ws, payload) for client_id, ws in targets),
+        return_exceptions=True
+    )
     disconnected = []
-    for client_id, client_info in clients.items():
-        if client_id != sender_id:
-            try:
-                await client_info["websocket"].send(json.dumps(message))
-                logger.info(f"✅ Forwarded to {client_id}")
-            except Exception as e:
-                logger.error(f"❌ Failed to send to {client_id}: {e}")
-                disconnected.append(client_id)
-                message_queue[client_id].append(message)
-    for client_id in disconnected:
-        if client_id in clients:
-            del clients[client_id]
+    for (client_id, ws), result in zip(targets, results):
+        if isinstance(result, Exception):
+            logger.error(f"❌ Failed to send to {client_id}: {result}")
+            enqueue_message(client_id, payload, key)
+            disconnected.append((client_id, ws))
+        else:
+            logger.info(f"✅ Forwarded to {client_id}")
+    if disconnected:
+        for client_id, ws in disconnected:
+            # Skip ids that reconnected on a new socket while we were sending
+            if client_id in clients and clients[client_id]["websocket"] is ws:
+                del clients[client_id]
+        _rebuild_view()
+
+
+async def fanout_worker(shard):
+    """Deliver queued broadcasts to the clients owned by one shard, in order."""
+    queue = fanout_queues[shard]
+    while True:
+        payload, key, sender_id = await queue.get()
+        try:
+            await _fanout(client_shards[shard], payload, key, sender_id)
+        except Exception as e:
+            logger.error(f"Fan-out shard {shard} failed: {e}")
+        finally:
+            queue.task_done()
 
 
 async def send_queued_messages(websocket, client_id):
     if client_id in message_queue and message_queue[client_id]:
-        logger.info(f"📤 Sending {len(message_queue[client_id])} queued messages to {client_id}")
-        for queued_msg in message_queue[client_id]:
-            try:
-                await websocket.send(json.dumps(queued_msg))
-            except Exception:
-                break
-        message_queue[client_id] = []
+        payloads = [payload for _, payload in message_queue.pop(client_id)]
+        dropped = queue_dropped.pop(client_id, 0)
+        if dropped:
+            # Tell the client its backlog is incomplete so it can REQUEST_HISTORY
+            payloads.insert(0, dumps({
+                "protocol_version": "0.3",
+                "message_type": "QUEUE_OVERFLOW",
+                "dropped": dropped,
+                "timestamp": utc_timestamp()
+            }))
+        logger.info(f"📤 Sending {len(payloads)} queued messages to {client_id} ({dropped} dropped)")
+        # Tasks start in order, so frames still reach the socket in queue order
+        await asyncio.gather(
+            *(websocket.send(payload) for payload in payloads),
+            return_exceptions=True
+        )
 
 
 async def handle_client(websocket):
     client_id = None
     try:
         hello_raw = await websocket.recv()
-        hello_msg = json.loads(hello_raw)
+        hello_msg = loads(hello_raw)
 
         if hello_msg.get("message_type") != "HELLO":
             await send_error(websocket, "INVALID_HANDSHAKE", "Expected HELLO", recoverable=False)
@@ -684,31 +967,21 @@ async def handle_client(websocket):
             "capabilities": hello_msg.get("capabilities", {}),
             "connected_at": datetime.now().isoformat()
         }
+        _rebuild_view()
+        websocket.transport.set_write_buffer_limits(
+            high=SLOW_CLIENT_HIGH_WATER, low=SLOW_CLIENT_LOW_WATER)
 
-        welcome_msg = {
-            "protocol_version": "0.3",
-            "message_type": "WELCOME",
-            "session_id": f"session-{client_id}",
-            "server_capabilities": {
-                "relay": True,
-                "persistence": True,
-                "history": True,
-                "message_queue": True,
-                "rooms": True
-            },
-            "heartbeat_interval": 30,
-            "connected_agents": list(clients.keys())
-        }
-        await websocket.send(json.dumps(welcome_msg))
+        await websocket.send(WELCOME_TEMPLATE % (
+            dumps(f"session-{client_id}"), dumps([client_id for client_id, _ in clients_view])))
 
         # Send current room list
         room_list_msg = {
             "protocol_version": "0.3",
             "message_type": "ROOM_LIST",
             "rooms": list(rooms),
-            "timestamp": datetime.utcnow().isoformat() + "Z"
+            "timestamp": utc_timestamp()
         }
-        await websocket.send(json.dumps(room_list_msg))
+        await websocket.send(dumps(room_list_msg))
         logger.info(f"📋 Sent ROOM_LIST ({len(rooms)} rooms) to {client_id}")
 
         # Send queued messages
@@ -719,15 +992,15 @@ async def handle_client(websocket):
             "protocol_version": "0.3",
             "message_type": "AGENT_JOINED",
             "sender": client_id,
-            "timestamp": datetime.utcnow().isoformat() + "Z"
+            "timestamp": utc_timestamp()
         }
-        await broadcast_message(agent_joined_msg, client_id)
+        broadcast_message(agent_joined_msg, client_id)
         logger.info(f"📢 Broadcasted AGENT_JOINED for {client_id}")
 
         # Main message loop
         async for message_raw in websocket:
             try:
-                message = json.loads(message_raw)
+                message = loads(message_raw)
                 msg_type = message.get("message_type")
 
                 if msg_type == "MESSAGE":
@@ -745,13 +1018,7 @@ async def handle_client(websocket):
                         display_name
                     )
 
-                    ack = {
-                        "protocol_version": "0.3",
-                        "message_type": "ACK",
-                        "message_id": message.get("message_id"),
-                        "timestamp": datetime.utcnow().isoformat() + "Z"
-                    }
-                    await websocket.send(json.dumps(ack))
+                    await websocket.send(ACK_TEMPLATE % (dumps(message.get("message_id")), utc_timestamp()))
 
                     if room_name not in rooms:
                         rooms.add(room_name)
@@ -759,42 +1026,37 @@ async def handle_client(websocket):
                             "protocol_version": "0.3",
                             "message_type": "ROOM_CREATED",
                             "room": room_name,
-                            "timestamp": datetime.utcnow().isoformat() + "Z"
+                            "timestamp": utc_timestamp()
                         }
-                        await broadcast_message(room_created_msg, None)
+                        broadcast_message(room_created_msg, None)
                         logger.info(f"🏠 New room created: #{room_name}")
 
-                    await broadcast_message(message, client_id)
+                    broadcast_message(message, client_id)
 
                 elif msg_type == "REQUEST_HISTORY":
                     since = message.get("since_timestamp")
                     room = message.get("room")  # Optional: filter by specific room
                     limit = message.get("limit")  # Optional: max messages per room (int)
-                    history = get_message_history(since, room=room, limit=limit)
+                    history = await get_message_history(since, room=room, limit=limit)
                     response = {
                         "protocol_version": "0.3",
                         "message_type": "HISTORY_RESPONSE",
                         "messages": history,
                         "room": room,  # Echo back the requested room for client routing
-                        "timestamp": datetime.utcnow().isoformat() + "Z"
+                        "timestamp": utc_timestamp()
                     }
-                    await websocket.send(json.dumps(response))
+                    await websocket.send(dumps(response))
                     room_label = f"#{room}" if room else "all rooms"
                     logger.info(f"✅ Sent {len(history)} history messages for {room_label} (limit={limit})")
 
                 elif msg_type == "PING":
-                    pong = {
-                        "protocol_version": "0.3",
-                        "message_type": "PONG",
-                        "timestamp": datetime.utcnow().isoformat() + "Z"
-                    }
-                    await websocket.send(json.dumps(pong))
+                    await websocket.send(PONG_TEMPLATE % utc_timestamp())
 
                 elif msg_type == "GOODBYE":
                     logger.info(f"👋 {client_id} said GOODBYE")
                     break
 
-            except json.JSONDecodeError as e:
+            except orjson.JSONDecodeError as e:
                 await send_error(websocket, "INVALID_JSON", str(e))
             except Exception as e:
                 logger.error(f"Error processing message: {e}")
@@ -806,14 +1068,15 @@ async def handle_client(websocket):
     finally:
         if client_id and client_id in clients:
             del clients[client_id]
+            _rebuild_view()
             logger.info(f"Removed {client_id}. Remaining: {len(clients)}")
             agent_left_msg = {
                 "protocol_version": "0.3",
                 "message_type": "AGENT_LEFT",
                 "sender": client_id,
-                "timestamp": datetime.utcnow().isoformat() + "Z"
+                "timestamp": utc_timestamp()
             }
-            await broadcast_message(agent_left_msg, client_id)
+            broadcast_message(agent_left_msg, client_id)
             logger.info(f"📢 Broadcasted AGENT_LEFT for {client_id}")
 
 
@@ -828,24 +1091,48 @@ async def main():
     stop = loop.create_future()
     loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
 
-    async with websockets.serve(
-        handle_client,
-        host="",
-        port=8080,
-        process_request=health_check,
-        max_size=20 * 1024 * 1024  # 20MB max message size
-    ):
-        logger.info("✅ Server running on port 8080")
-        logger.info("✅ Health check at /healthz")
-        logger.info("✅ Admin rooms at /admin/rooms (X-Admin-Secret header required)")
-        logger.info("✅ Admin purge at /admin/rooms/purge?hours=N")
-        logger.info(f"✅ History cap: {HISTORY_CAP_PER_ROOM} messages per room")
-        logger.info("✅ REQUEST_HISTORY supports 'room' and 'limit' params")
-        logger.info("✅ display_name persisted in DB and returned in history")
-        logger.info("=" * 60)
-        await stop
-        logger.info("🛑 Shutting down gracefully...")
+    writer_task = asyncio.create_task(message_writer())
+    fanout_tasks = [asyncio.create_task(fanout_worker(shard)) for shard in range(FANOUT_SHARDS)]
+
+    try:
+        async with websockets.serve(
+            handle_client,
+            host="",
+            port=8080,
+            process_request=health_check,
+            max_size=20 * 1024 * 1024,  # 20MB max message size
+            # Same negotiation as websockets' default deflate, minus compressing tiny frames
+            compression=None,
+            extensions=[SelectiveDeflateFactory(
+                server_max_window_bits=12,
+                client_max_window_bits=12,
+                compress_settings={"memLevel": 5},
+            )]
+        ):
+            logger.info("✅ Server running on port 8080")
+            logger.info("✅ Health check at /healthz")
+            logger.info("✅ Admin rooms at /admin/rooms (X-Admin-Secret header required)")
+            logger.info("✅ Admin purge at /admin/rooms/purge?hours=N")
+            logger.info(f"✅ History cap: {HISTORY_CAP_PER_ROOM} messages per room")
+            logger.info("✅ REQUEST_HISTORY supports 'room' and 'limit' params")
+            logger.info("✅ display_name persisted in DB and returned in history")
+            logger.info("=" * 60)
+            await stop
+            logger.info("🛑 Shutting down gracefully...")
+    finally:
+        try:
+            await asyncio.wait_for(pending_writes.join(), timeout=10)
+        except asyncio.TimeoutError:
+            logger.error(f"Dropped {pending_writes.qsize()} unwritten messages on shutdown")
+        writer_task.cancel()
+        for task in fanout_tasks:
+            task.cancel()
+        await db_writer_pool.close()
+        await db_reader_pool.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
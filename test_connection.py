@@ -1,157 +1,275 @@
 #!/usr/bin/env python3
 """
 Test script for Multi-Agent Relay Server
-Usage: python test_connection.py wss://your-relay-url.com
+Usage: python test_connection.py wss://your-relay-url.com [more URLs...] [--compress | --no-compress] [--iterations N] [-q] [--verbose]
 """
 
-import asyncio
+import argparse
+import logging
 import websockets
-import json
 import sys
-from datetime import datetime
+import time
+from websockets.sync.client import connect
 
-async def test_relay(url):
+try:
+    import orjson
+    # Decoded to str so frames go out as text, like real agents send them
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+    loads = orjson.loads
+except ImportError:
+    import json
+    dumps = json.dumps
+    loads = json.loads
+
+log = logging.getLogger("relay-test")
+
+# Constant frames, encoded once
+_HELLO = dumps({
+    "protocol_version": "0.3",
+    "message_type": "HELLO",
+    "sender": "test_client",
+    "capabilities": {"test": True}
+})
+_PING = dumps({"protocol_version": "0.3", "message_type": "PING"})
+_REQUEST_HISTORY = dumps({"protocol_version": "0.3", "message_type": "REQUEST_HISTORY"})
+_GOODBYE = dumps({"protocol_version": "0.3", "message_type": "GOODBYE"})
+
+# MESSAGE is the only per-send frame: one dict reused, with message_id and
+# timestamp overwritten before each encode
+_MSG_TEMPLATE = {
+    "protocol_version": "0.3",
+    "message_type": "MESSAGE",
+    "message_id": None,
+    "sender": "test_client",
+    "content": "Test message from connection tester",
+    "timestamp": None
+}
+_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# The relay writes protocol_version then message_type first, so a frame's type
+# can be read off its first bytes without decoding the whole frame
+_TYPE_MARKERS = {
+    message_type: f'"message_type":"{message_type}"'
+    for message_type in ("PONG", "ACK", "HISTORY_RESPONSE")
+}
+
+
+def frame_type(raw, candidates):
+    """Return which of `candidates` the frame is, or None, decoding only if needed."""
+    head = raw[:64]
+    for message_type in candidates:
+        if _TYPE_MARKERS[message_type] in head:
+            return message_type
+    if '"message_type"' in head:
+        return None  # some other canonical frame (ROOM_LIST, AGENT_JOINED...)
+    message_type = loads(raw).get("message_type")
+    return message_type if message_type in candidates else None
+
+
+def test_relay(url, args):
     """Test connection to relay server"""
-    print("=" * 60)
-    print("Multi-Agent Relay Connection Test")
-    print("=" * 60)
-    print(f"Testing: {url}")
-    print()
+    # Output is buffered and written once per phase; with -q nothing is
+    # formatted or written at all, only the return value matters
+    out = []
+    
+    if args.quiet:
+        def say(line=""):
+            pass
+    else:
+        def say(line=""):
+            out.append(f"{line}\n")
+    
+    def flush():
+        if out:
+            sys.stdout.write("".join(out))
+            sys.stdout.flush()
+            out.clear()
+    
+    say("=" * 60)
+    say("Multi-Agent Relay Connection Test")
+    say("=" * 60)
+    say(f"Testing: {url}")
+    say(f"Compression: {'permessage-deflate' if args.compress else 'off'}")
+    say()
+    flush()
     
     try:
-        print("[1/6] Connecting...")
-        async with websockets.connect(url) as websocket:
-            print("✅ Connected!")
+        say("[1/6] Connecting...")
+        # Single consumer, no concurrency needed: the sync client avoids the
+        # event loop entirely.
+        # Deflate saves bandwidth on large HISTORY_RESPONSEs over the internet;
+        # turn it off for localhost benchmarks so it doesn't skew timings
+        with connect(
+            url,
+            compression="deflate" if args.compress else None,
+            # A full HISTORY_RESPONSE can exceed the 1 MiB default frame cap
+            max_size=16 * 1024 * 1024,
+            open_timeout=5
+        ) as websocket:
+            say("✅ Connected!")
+            flush()
             
             # Test 1: HELLO/WELCOME
-            print("\n[2/6] Testing HELLO/WELCOME handshake...")
-            hello = {
-                "protocol_version": "0.3",
-                "message_type": "HELLO",
-                "sender": "test_client",
-                "capabilities": {"test": True}
-            }
-            await websocket.send(json.dumps(hello))
+            say("\n[2/6] Testing HELLO/WELCOME handshake...")
+            websocket.send(_HELLO)
             
-            welcome_raw = await websocket.recv()
-            welcome = json.loads(welcome_raw)
+            welcome_raw = websocket.recv()
+            welcome = loads(welcome_raw)
             
             if welcome.get("message_type") == "WELCOME":
-                print("✅ WELCOME received!")
-                print(f"   Session ID: {welcome.get('session_id')}")
-                print(f"   Connected agents: {welcome.get('connected_agents')}")
-                print(f"   Server capabilities: {welcome.get('server_capabilities')}")
+                say("✅ WELCOME received!")
+                say(f"   Session ID: {welcome.get('session_id')}")
+                say(f"   Connected agents: {welcome.get('connected_agents')}")
+                say(f"   Server capabilities: {welcome.get('server_capabilities')}")
             else:
-                print(f"❌ Expected WELCOME, got {welcome.get('message_type')}")
+                say(f"❌ Expected WELCOME, got {welcome.get('message_type')}")
                 return False
+            flush()
             
-            # Test 2: PING/PONG
-            print("\n[3/6] Testing PING/PONG...")
-            ping = {
-                "protocol_version": "0.3",
-                "message_type": "PING"
-            }
-            await websocket.send(json.dumps(ping))
-            
-            pong_raw = await websocket.recv()
-            pong = json.loads(pong_raw)
-            
-            if pong.get("message_type") == "PONG":
-                print("✅ PONG received!")
-            else:
-                print(f"❌ Expected PONG, got {pong.get('message_type')}")
-                return False
+            # Tests 2-4 are independent: send PING, MESSAGE and REQUEST_HISTORY
+            # back to back and match replies by type, so they share one round trip.
+            # With --iterations they repeat over this connection; only the first
+            # round is reported in detail
+            say("\n[3-5/6] Testing PING/PONG, MESSAGE send and HISTORY retrieval (pipelined)...")
+            report = True
             
-            # Test 3: Send MESSAGE
-            print("\n[4/6] Testing MESSAGE send...")
-            message = {
-                "protocol_version": "0.3",
-                "message_type": "MESSAGE",
-                "message_id": f"test-{int(datetime.now().timestamp())}",
-                "sender": "test_client",
-                "content": "Test message from connection tester",
-                "timestamp": datetime.utcnow().isoformat() + "Z"
-            }
-            await websocket.send(json.dumps(message))
+            def check_pong(raw):
+                if report:
+                    say("✅ PONG received!")
             
-            ack_raw = await websocket.recv()
-            ack = json.loads(ack_raw)
+            def check_ack(raw):
+                if report:
+                    ack = loads(raw)
+                    say("✅ ACK received!")
+                    say(f"   Message ID: {ack.get('message_id')}")
             
-            if ack.get("message_type") == "ACK":
-                print("✅ ACK received!")
-                print(f"   Message ID: {ack.get('message_id')}")
-            else:
-                print(f"❌ Expected ACK, got {ack.get('message_type')}")
-                return False
+            def check_history(raw):
+                if report:
+                    history = loads(raw)
+                    say("✅ HISTORY received!")
+                    say(f"   Messages in history: {len(history.get('messages', []))}")
+                    if history.get('messages'):
+                        say(f"   Latest message: {history['messages'][-1].get('content', '')[:50]}...")
             
-            # Test 4: Request HISTORY
-            print("\n[5/6] Testing HISTORY retrieval...")
-            history_req = {
-                "protocol_version": "0.3",
-                "message_type": "REQUEST_HISTORY"
+            checks = {
+                "PONG": check_pong,
+                "ACK": check_ack,
+                "HISTORY_RESPONSE": check_history
             }
-            await websocket.send(json.dumps(history_req))
-            
-            history_raw = await websocket.recv()
-            history = json.loads(history_raw)
-            
-            if history.get("message_type") == "HISTORY_RESPONSE":
-                print("✅ HISTORY received!")
-                print(f"   Messages in history: {len(history.get('messages', []))}")
-                if history.get('messages'):
-                    print(f"   Latest message: {history['messages'][-1].get('content', '')[:50]}...")
-            else:
-                print(f"❌ Expected HISTORY_RESPONSE, got {history.get('message_type')}")
-                return False
+            # message_ids are a fixed per-run prefix plus the iteration counter;
+            # the timestamp's seconds part is only re-rendered when it changes
+            run_id = time.time_ns()
+            secs_cached = None
+            start = time.perf_counter_ns()
+            for i in range(args.iterations):
+                ns = time.time_ns()
+                secs = ns // 1_000_000_000
+                if secs != secs_cached:
+                    secs_cached = secs
+                    secs_text = time.strftime(_TIMESTAMP_FORMAT, time.gmtime(secs))
+                _MSG_TEMPLATE["message_id"] = f"test-{run_id}-{i}"
+                _MSG_TEMPLATE["timestamp"] = f"{secs_text}.{(ns // 1000) % 1_000_000:06d}Z"
+                websocket.send(_PING)
+                websocket.send(dumps(_MSG_TEMPLATE))
+                websocket.send(_REQUEST_HISTORY)
+                
+                validators = dict(checks)
+                try:
+                    while validators:
+                        raw = websocket.recv(timeout=10)
+                        # Unsolicited frames (ROOM_LIST, AGENT_JOINED, broadcasts...) are
+                        # skipped without being decoded
+                        message_type = frame_type(raw, validators)
+                        if message_type:
+                            validators.pop(message_type)(raw)
+                except TimeoutError:
+                    say(f"❌ No reply for: {', '.join(validators)} (iteration {i + 1})")
+                    return False
+                report = False
+            elapsed_ns = time.perf_counter_ns() - start
+            if args.iterations > 1:
+                ops = args.iterations * len(checks)
+                say(f"✅ {args.iterations} iterations in {elapsed_ns / 1e6:.1f} ms")
+                say(f"   {ops * 1e9 / elapsed_ns:,.0f} ops/s ({elapsed_ns / ops / 1e3:.1f} µs per request/reply)")
+            flush()
             
             # Test 5: GOODBYE
-            print("\n[6/6] Testing graceful disconnect...")
-            goodbye = {
-                "protocol_version": "0.3",
-                "message_type": "GOODBYE"
-            }
-            await websocket.send(json.dumps(goodbye))
-            print("✅ GOODBYE sent!")
+            say("\n[6/6] Testing graceful disconnect...")
+            websocket.send(_GOODBYE)
+            say("✅ GOODBYE sent!")
             
-            print("\n" + "=" * 60)
-            print("🎉 ALL TESTS PASSED!")
-            print("=" * 60)
-            print("\nRelay server is working correctly!")
-            print(f"URL: {url}")
-            print("\nYou can now use this relay for agent communication.")
+            say("\n" + "=" * 60)
+            say("🎉 ALL TESTS PASSED!")
+            say("=" * 60)
+            say("\nRelay server is working correctly!")
+            say(f"URL: {url}")
+            say("\nYou can now use this relay for agent communication.")
             return True
             
     except websockets.exceptions.InvalidURI:
-        print(f"❌ Invalid URL: {url}")
-        print("   Make sure to use wss:// for HTTPS or ws:// for HTTP")
+        say(f"❌ Invalid URL: {url}")
+        say("   Make sure to use wss:// for HTTPS or ws:// for HTTP")
         return False
-    except websockets.exceptions.InvalidStatusCode as e:
-        print(f"❌ Connection failed with status {e.status_code}")
-        print("   Server might not be running or URL is incorrect")
+    except websockets.exceptions.InvalidStatus as e:
+        say(f"❌ Connection failed with status {e.response.status_code}")
+        say("   Server might not be running or URL is incorrect")
         return False
     except ConnectionRefusedError:
-        print("❌ Connection refused")
-        print("   Server might not be running or firewall is blocking")
+        say("❌ Connection refused")
+        say("   Server might not be running or firewall is blocking")
         return False
     except Exception as e:
-        print(f"❌ Error: {e}")
-        import traceback
-        traceback.print_exc()
+        if args.verbose:
+            log.warning("Error: %s", e, exc_info=True)
+        else:
+            say(f"❌ Error: {e}")
         return False
+    finally:
+        flush()
+
+EXAMPLES = """examples:
+  python test_connection.py wss://my-relay.railway.app
+  python test_connection.py wss://my-relay.onrender.com
+  python test_connection.py wss://my-relay.fly.dev
+  python test_connection.py ws://localhost:8080 --no-compress
+  python test_connection.py wss://my-relay.railway.app wss://my-relay.fly.dev
+  python test_connection.py ws://localhost:8080 --no-compress --iterations 1000
+"""
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(
+        description="Test connection to a Multi-Agent Relay Server",
+        epilog=EXAMPLES,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    ap.add_argument("url", nargs="+", help="relay URL(s), wss:// for HTTPS or ws:// for HTTP")
+    ap.add_argument("--compress", action=argparse.BooleanOptionalAction, default=True,
+                    help="negotiate permessage-deflate (default: on)")
+    ap.add_argument("--iterations", type=int, default=1, metavar="N",
+                    help="repeat the PING/MESSAGE/HISTORY round N times over one connection")
+    ap.add_argument("-q", "--quiet", action="store_true", help="no output, exit code only")
+    ap.add_argument("--verbose", action="store_true", help="log tracebacks for unexpected errors")
+    return ap.parse_args()
+
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python test_connection.py wss://your-relay-url.com")
-        print("\nExamples:")
-        print("  python test_connection.py wss://my-relay.railway.app")
-        print("  python test_connection.py wss://my-relay.onrender.com")
-        print("  python test_connection.py wss://my-relay.fly.dev")
-        sys.exit(1)
+    args = parse_args()
+    if args.iterations < 1:
+        sys.exit("--iterations must be at least 1")
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s")
     
-    url = sys.argv[1]
+    # One connection per distinct URL, reused for its whole test sequence
+    urls = list(dict.fromkeys(args.url))
     
     # Run test
-    success = asyncio.run(test_relay(url))
+    results = {url: test_relay(url, args) for url in urls}
+    success = all(results.values())
+    if len(urls) > 1 and not args.quiet:
+        print("\nSummary:")
+        for url, passed in results.items():
+            print(f"  {'✅' if passed else '❌'} {url}")
     
     sys.exit(0 if success else 1)
 
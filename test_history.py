@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+History tests for Multi-Agent Relay Server (no running relay needed)
+Usage: python -m unittest test_history
+"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+import app
+
+
+class RecentWindowHistoryTest(unittest.IsolatedAsyncioTestCase):
+    """The in-memory recent window must answer exactly like SQLite."""
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        app.DB_PATH = os.path.join(self.tmp.name, "relay_server.db")
+        app.pending_writes = asyncio.Queue()
+        app.recent_messages.clear()
+        app.recent_message_ids.clear()
+        app.init_database()
+        self.writer = asyncio.create_task(app.message_writer())
+
+    async def asyncTearDown(self):
+        self.writer.cancel()
+        await app.db_writer_pool.close()
+        await app.db_reader_pool.close()
+        self.tmp.cleanup()
+
+    async def sql_history_since(self, since_timestamp):
+        async with app.db_reader_pool.connection() as conn:
+            rows = await conn.execute_fetchall(app.SQL_HISTORY_SINCE, (since_timestamp,))
+        return [app._row_to_message(row) for row in rows]
+
+    async def test_non_string_timestamp(self):
+        app.store_message("num", "agent", "numeric", 1700000000)
+        app.store_message("late", "agent", "numeric", 9999)
+        app.store_message("str", "agent", "text", "2026-01-01T00:00:00.000000Z")
+        for since in ("1", "2025-12-31T00:00:00Z", "9"):
+            history = await app.get_message_history(since_timestamp=since)
+            self.assertEqual(history, await self.sql_history_since(since))
+        history = await app.get_message_history(since_timestamp="1")
+        self.assertEqual([m["timestamp"] for m in history],
+                         ["1700000000", "2026-01-01T00:00:00.000000Z", "9999"])
+
+    async def test_missing_timestamp_is_not_stored(self):
+        app.store_message("none", "agent", "no timestamp", None)
+        app.store_message("ok", "agent", "text", "2026-01-01T00:00:00.000000Z")
+        history = await app.get_message_history(since_timestamp="2025")
+        self.assertEqual([m["message_id"] for m in history], ["ok"])
+
+    async def test_empty_since_timestamp_is_latest_per_room(self):
+        for i in range(app.HISTORY_CAP_PER_ROOM + 5):
+            app.store_message(f"m{i}", "agent", "text", f"2026-01-01T00:00:{i:06d}Z")
+        history = await app.get_message_history(since_timestamp="")
+        self.assertEqual(history, await app.get_message_history())
+        self.assertEqual(len(history), app.HISTORY_CAP_PER_ROOM)
+
+
+if __name__ == "__main__":
+    unittest.main()